@@ -6,6 +6,7 @@ Simple test for update_integrity.py functionality.
 import os
 import sys
 import tempfile
+import time
 import json
 import pathlib
 import shutil
@@ -13,6 +14,7 @@ import shutil
 # Add tools directory to path to import our module
 sys.path.insert(0, os.path.dirname(__file__))
 
+import update_integrity
 from update_integrity import PrivateRegistryClient, integrity, json_dump
 
 
@@ -49,6 +51,10 @@ def create_test_registry():
     with open(overlay_dir / "MODULE.bazel", "w") as f:
         f.write('module(name = "testmod", version = "1.0.0")\n')
     
+    (overlay_dir / "test").mkdir()
+    with open(overlay_dir / "test" / "BUILD.bazel", "w") as f:
+        f.write("# Test nested BUILD file\n")
+    
     # Create patches
     patches_dir = module_dir / "patches"
     patches_dir.mkdir()
@@ -59,78 +65,235 @@ def create_test_registry():
     return temp_dir
 
 
-def test_update_integrity():
+def with_test_registry(test_func):
+    """Run test_func(client, registry_root) on a fresh test registry, report and clean up."""
+    def run():
+        print(f"Running {test_func.__name__}...")
+        test_registry = create_test_registry()
+        
+        try:
+            print(f"Test registry created at: {test_registry}")
+            test_func(PrivateRegistryClient(test_registry), pathlib.Path(test_registry))
+            
+            print("\n✅ All tests passed!")
+            return True
+            
+        except Exception as e:
+            print(f"\n❌ Test failed: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+            
+        finally:
+            # Cleanup
+            print(f"Cleaning up test registry: {test_registry}")
+            shutil.rmtree(test_registry)
+    
+    # No functools.wraps: pytest would take the wrapped signature as fixtures
+    run.__name__ = test_func.__name__
+    run.__doc__ = test_func.__doc__
+    return run
+
+
+@with_test_registry
+def test_update_integrity(client, registry_root):
     """Test the update_integrity functionality."""
-    print("Creating test registry...")
-    test_registry = create_test_registry()
+    # Test module listing
+    modules = client.get_all_modules()
+    assert "testmod" in modules, f"Expected 'testmod' in modules, got: {modules}"
+    print("✓ Module listing works")
+    
+    # Test version listing
+    versions = client.get_module_versions("testmod")
+    assert "1.0.0" in versions, f"Expected '1.0.0' in versions, got: {versions}"
+    print("✓ Version listing works")
+    
+    # Test module existence check
+    assert client.module_exists("testmod"), "Module should exist"
+    assert client.module_exists("testmod", "1.0.0"), "Module version should exist"
+    assert not client.module_exists("nonexistent"), "Nonexistent module should not exist"
+    print("✓ Module existence checks work")
+    
+    # Test source.json loading
+    source = client.get_source("testmod", "1.0.0")
+    assert source["url"] == "file:///dev/null", "URL should match"
+    assert source["integrity"] == "old-invalid-hash", "Integrity should match initial value"
+    print("✓ Source.json loading works")
+    
+    # Test update_integrity
+    print("Running update_integrity...")
+    client.update_integrity("testmod", "1.0.0")
+    
+    # Verify the update
+    updated_source = client.get_source("testmod", "1.0.0")
+    
+    # Check that main integrity was updated (file:///dev/null returns empty content)
+    expected_empty_hash = integrity(b"")  # Empty file hash
+    assert updated_source["integrity"] == expected_empty_hash, \
+        f"Expected {expected_empty_hash}, got {updated_source['integrity']}"
+    print("✓ Main archive integrity updated correctly")
+    
+    # Check overlay hashes
+    assert "overlay" in updated_source, "Overlay section should exist"
+    assert "BUILD.bazel" in updated_source["overlay"], "BUILD.bazel should be in overlay"
+    assert "MODULE.bazel" in updated_source["overlay"], "MODULE.bazel should be in overlay"
+    expected_build_hash = integrity(b"# Test BUILD file\n")
+    assert updated_source["overlay"]["BUILD.bazel"] == expected_build_hash, \
+        f"Expected {expected_build_hash}, got {updated_source['overlay']['BUILD.bazel']}"
+    assert os.path.join("test", "BUILD.bazel") in updated_source["overlay"], \
+        "Nested test/BUILD.bazel should be in overlay"
+    assert list(updated_source["overlay"]) == sorted(updated_source["overlay"]), \
+        "Overlay entries should be sorted"
+    print("✓ Overlay integrity computed correctly")
+    
+    # Check patches hashes
+    assert "patches" in updated_source, "Patches section should exist"
+    assert "test.patch" in updated_source["patches"], "test.patch should be in patches"
+    print("✓ Patches integrity computed correctly")
+
+
+@with_test_registry
+def test_update_integrity_incremental(client, registry_root):
+    """Test that incremental update reuses hashes of unchanged files."""
+    module_dir = registry_root / "modules" / "testmod" / "1.0.0"
+    
+    # Record a known hash and make overlay files older than source.json
+    source = client.get_source("testmod", "1.0.0")
+    source["overlay"] = {"BUILD.bazel": "sha256-kept"}
+    json_dump(module_dir / "source.json", source)
+    os.utime(module_dir / "overlay" / "BUILD.bazel", ns=(0, 0))
+    
+    client.update_integrity("testmod", "1.0.0", incremental=True)
+    updated_source = client.get_source("testmod", "1.0.0")
+    assert updated_source["overlay"]["BUILD.bazel"] == "sha256-kept", \
+        "Unchanged BUILD.bazel should keep recorded hash"
+    assert updated_source["overlay"]["MODULE.bazel"].startswith("sha256-"), \
+        "New MODULE.bazel should be hashed"
+    print("✓ Incremental update reuses unchanged hashes")
+    
+    # Recorded hash of a file modified after source.json must not be reused
+    future_ns = (time.time_ns() + 3600 * 10**9,) * 2
+    os.utime(module_dir / "overlay" / "BUILD.bazel", ns=future_ns)
+    client.update_integrity("testmod", "1.0.0", incremental=True)
+    updated_source = client.get_source("testmod", "1.0.0")
+    expected_build_hash = integrity(b"# Test BUILD file\n")
+    assert updated_source["overlay"]["BUILD.bazel"] == expected_build_hash, \
+        "Modified BUILD.bazel should be rehashed"
+    print("✓ Incremental update rehashes modified files")
+    
+    # Without incremental even unchanged files with recorded hash are rehashed
+    updated_source["overlay"]["BUILD.bazel"] = "sha256-kept"
+    json_dump(module_dir / "source.json", updated_source)
+    os.utime(module_dir / "overlay" / "BUILD.bazel", ns=(0, 0))
+    client.update_integrity("testmod", "1.0.0")
+    updated_source = client.get_source("testmod", "1.0.0")
+    assert updated_source["overlay"]["BUILD.bazel"] == expected_build_hash, \
+        "Full update should rehash BUILD.bazel"
+    print("✓ Full update rehashes all files")
+
+
+@with_test_registry
+def test_update_all(client, registry_root):
+    """Test updating all modules and versions at once."""
+    # Add second version without patches
+    shutil.copytree(
+        registry_root / "modules" / "testmod" / "1.0.0",
+        registry_root / "modules" / "testmod" / "1.1.0",
+    )
+    shutil.rmtree(registry_root / "modules" / "testmod" / "1.1.0" / "patches")
+    
+    client.update_all()
+    
+    expected_empty_hash = integrity(b"")
+    for version in ("1.0.0", "1.1.0"):
+        updated_source = client.get_source("testmod", version)
+        assert updated_source["integrity"] == expected_empty_hash, \
+            f"Main archive integrity of {version} should be updated"
+        assert "BUILD.bazel" in updated_source["overlay"], \
+            f"BUILD.bazel should be in overlay of {version}"
+    assert "patches" in client.get_source("testmod", "1.0.0"), "Patches section should exist"
+    assert "patches" not in client.get_source("testmod", "1.1.0"), "Patches section should be removed"
+    print("✓ All modules and versions updated")
+
+
+@with_test_registry
+def test_update_all_failures(client, registry_root):
+    """Test that failing versions don't stop updating the others."""
+    module_dir = registry_root / "modules" / "testmod"
+    # Broken versions sort before the valid 1.0.0
+    (module_dir / "0.9.0").mkdir()
+    shutil.copytree(module_dir / "1.0.0", module_dir / "0.9.1")
+    source = client.get_source("testmod", "0.9.1")
+    source["url"] = "file:///nonexistent/archive.tar.gz"
+    json_dump(module_dir / "0.9.1" / "source.json", source)
     
     try:
-        print(f"Test registry created at: {test_registry}")
-        
-        # Initialize client
-        client = PrivateRegistryClient(test_registry)
-        
-        # Test module listing
-        modules = client.get_all_modules()
-        assert "testmod" in modules, f"Expected 'testmod' in modules, got: {modules}"
-        print("✓ Module listing works")
-        
-        # Test version listing
-        versions = client.get_module_versions("testmod")
-        assert "1.0.0" in versions, f"Expected '1.0.0' in versions, got: {versions}"
-        print("✓ Version listing works")
-        
-        # Test module existence check
-        assert client.module_exists("testmod"), "Module should exist"
-        assert client.module_exists("testmod", "1.0.0"), "Module version should exist"
-        assert not client.module_exists("nonexistent"), "Nonexistent module should not exist"
-        print("✓ Module existence checks work")
-        
-        # Test source.json loading
-        source = client.get_source("testmod", "1.0.0")
-        assert source["url"] == "file:///dev/null", "URL should match"
-        assert source["integrity"] == "old-invalid-hash", "Integrity should match initial value"
-        print("✓ Source.json loading works")
-        
-        # Test update_integrity
-        print("Running update_integrity...")
+        client.update_all()
+    except RuntimeError as e:
+        assert "testmod@0.9.0" in str(e), f"Missing source.json should be reported, got: {e}"
+        assert "testmod@0.9.1" in str(e), f"Failed download should be reported, got: {e}"
+        assert "testmod@1.0.0" not in str(e), f"Valid version should not be reported, got: {e}"
+    else:
+        raise AssertionError("update_all should raise for failed versions")
+    
+    updated_source = client.get_source("testmod", "1.0.0")
+    assert updated_source["integrity"] == integrity(b""), "Valid version should still be updated"
+    print("✓ Failed versions reported, others updated")
+
+
+@with_test_registry
+def test_integrity_cache(client, registry_root):
+    """Test that hashes are shared only between hardlinks within one update."""
+    overlay_dir = registry_root / "modules" / "testmod" / "1.0.0" / "overlay"
+    
+    # Distinct files with the same size and mtime
+    for name, content in (("a.txt", b"aaaa"), ("b.txt", b"bbbb")):
+        with open(overlay_dir / name, "wb") as f:
+            f.write(content)
+        os.utime(overlay_dir / name, ns=(10**18, 10**18))
+    
+    # Hardlinked files
+    os.link(overlay_dir / "BUILD.bazel", overlay_dir / "BUILD.link.bazel")
+    
+    hashed_paths = []
+    original_integrity_path = update_integrity.integrity_path
+    def counting_integrity_path(path, *args):
+        hashed_paths.append(os.path.relpath(path, overlay_dir))
+        return original_integrity_path(path, *args)
+    
+    update_integrity.integrity_path = counting_integrity_path
+    try:
         client.update_integrity("testmod", "1.0.0")
-        
-        # Verify the update
-        updated_source = client.get_source("testmod", "1.0.0")
-        
-        # Check that main integrity was updated (file:///dev/null returns empty content)
-        expected_empty_hash = integrity(b"")  # Empty file hash
-        assert updated_source["integrity"] == expected_empty_hash, \
-            f"Expected {expected_empty_hash}, got {updated_source['integrity']}"
-        print("✓ Main archive integrity updated correctly")
-        
-        # Check overlay hashes
-        assert "overlay" in updated_source, "Overlay section should exist"
-        assert "BUILD.bazel" in updated_source["overlay"], "BUILD.bazel should be in overlay"
-        assert "MODULE.bazel" in updated_source["overlay"], "MODULE.bazel should be in overlay"
-        print("✓ Overlay integrity computed correctly")
-        
-        # Check patches hashes
-        assert "patches" in updated_source, "Patches section should exist"
-        assert "test.patch" in updated_source["patches"], "test.patch should be in patches"
-        print("✓ Patches integrity computed correctly")
-        
-        print("\n✅ All tests passed!")
-        return True
-        
-    except Exception as e:
-        print(f"\n❌ Test failed: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
-        
     finally:
-        # Cleanup
-        print(f"Cleaning up test registry: {test_registry}")
-        shutil.rmtree(test_registry)
+        update_integrity.integrity_path = original_integrity_path
+    
+    overlay = client.get_source("testmod", "1.0.0")["overlay"]
+    assert overlay["a.txt"] == integrity(b"aaaa"), "a.txt should have its own hash"
+    assert overlay["b.txt"] == integrity(b"bbbb"), "b.txt should have its own hash"
+    print("✓ Files with same size and mtime hashed separately")
+    
+    expected_build_hash = integrity(b"# Test BUILD file\n")
+    assert overlay["BUILD.bazel"] == overlay["BUILD.link.bazel"] == expected_build_hash, \
+        "Hardlinked files should both get the hash"
+    linked_hashes = [p for p in hashed_paths if p in ("BUILD.bazel", "BUILD.link.bazel")]
+    assert len(linked_hashes) == 1, f"Hardlinked files should be hashed once, got: {linked_hashes}"
+    print("✓ Hardlinked files hashed once")
+    
+    # Same inode, size and mtime but new content must be seen by the next update
+    st = os.stat(overlay_dir / "a.txt")
+    with open(overlay_dir / "a.txt", "r+b") as f:
+        f.write(b"cccc")
+    os.utime(overlay_dir / "a.txt", ns=(st.st_atime_ns, st.st_mtime_ns))
+    client.update_integrity("testmod", "1.0.0")
+    overlay = client.get_source("testmod", "1.0.0")["overlay"]
+    assert overlay["a.txt"] == integrity(b"cccc"), "Rewritten a.txt should be rehashed"
+    print("✓ Next update rehashes file rewritten in place")
 
 
 if __name__ == "__main__":
     success = test_update_integrity()
+    success = test_update_integrity_incremental() and success
+    success = test_update_all() and success
+    success = test_update_all_failures() and success
+    success = test_integrity_cache() and success
     sys.exit(0 if success else 1)
\ No newline at end of file
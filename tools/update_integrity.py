@@ -8,54 +8,217 @@ Private registry integrity updater.
 
 import os
 import sys
+import stat
 import json
 import hashlib
-import base64
+import binascii
 import pathlib
 import urllib.request
 import urllib.error
+import threading
+import functools
+import concurrent.futures
 
 
-def download(url):
-    """Download file from URL and return its content."""
+# Bazel verifies overlay and patch hashes as well, so keep to SRI algorithms only
+SRI_ALGORITHMS = {
+    "sha224": hashlib.sha224,
+    "sha256": hashlib.sha256,
+    "sha384": hashlib.sha384,
+    "sha512": hashlib.sha512,
+}
+
+READ_BUFFER_SIZE = 1 << 18
+
+_read_buffers = threading.local()
+
+_json_decoder = json.JSONDecoder()
+
+
+def sri(hash_obj):
+    """Format finished hash object in SRI format."""
+    encoded = binascii.b2a_base64(hash_obj.digest(), newline=False).decode("ascii")
+    return f"{hash_obj.name}-{encoded}"
+
+
+def integrity(data, algorithm="sha256"):
+    """Calculate integrity hash in SRI format."""
+    assert algorithm in SRI_ALGORITHMS, "Unsupported SRI algorithm"
+    
+    return sri(SRI_ALGORITHMS[algorithm](data))
+
+
+def _read_buffer():
+    """Get read buffer reused by all files hashed on the current thread."""
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _read_buffers.buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+    return buffer
+
+
+def _update_from_stream(hash_obj, stream):
+    """Feed binary stream into hash object chunk by chunk."""
+    buffer = _read_buffer()
+    while True:
+        size = stream.readinto(buffer)
+        if not size:
+            break
+        hash_obj.update(buffer[:size])
+    return hash_obj
+
+
+def _fadvise(fd, advice):
+    """Give kernel a hint about access pattern for whole file, where supported."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def integrity_path(path, algorithm="sha256", size=None):
+    """Calculate integrity hash in SRI format streaming the file from local path."""
+    assert algorithm in SRI_ALGORITHMS, "Unsupported SRI algorithm"
+
+    # Unbuffered: reads go straight into the pooled buffer, skip BufferedReader setup syscalls
+    with open(path, "rb", buffering=0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        # Files fitting into one read gain nothing from hints, spare them the syscalls
+        advise = size > READ_BUFFER_SIZE
+        if advise:
+            _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+            if size > 1 << 20:
+                _fadvise(f.fileno(), "POSIX_FADV_WILLNEED")
+        result = sri(_update_from_stream(SRI_ALGORITHMS[algorithm](), f))
+        if advise:
+            # Hashed bytes are not read again, don't keep them in page cache
+            _fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
+        return result
+
+
+def integrity_entry(entry, algorithm="sha256", cache=None):
+    """Calculate integrity hash in SRI format for directory entry.
+    
+    Results are kept in cache dict as futures by (st_dev, st_ino, st_size, st_mtime_ns, algorithm),
+    so hardlinked files are hashed once per cache even from concurrent threads.
+    """
+    # DirEntry caches its stat result, so the scan pays for it at most once
+    st = entry.stat()
+    if cache is None or not st.st_ino:
+        # No cache, or Windows DirEntry.stat() left st_ino and st_dev zero and the file can't be identified
+        return integrity_path(entry.path, algorithm, st.st_size)
+    
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm)
+    # setdefault is atomic, the first thread hashes and others wait for its result
+    future = concurrent.futures.Future()
+    cached = cache.setdefault(key, future)
+    if cached is future:
+        try:
+            future.set_result(integrity_path(entry.path, algorithm, st.st_size))
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+    return cached.result()
+
+
+def url_integrity(url, algorithm="sha256"):
+    """Calculate integrity hash in SRI format streaming the file from URL."""
     if url.startswith("file://"):
-        # Handle file:// URLs for testing
+        # Handle file:// URLs for testing, hash in place instead of downloading
         file_path = url[7:]  # Remove file:// prefix
-        with open(file_path, "rb") as f:
-            return f.read()
-    
+        return integrity_path(file_path, algorithm)
+
+    assert algorithm in SRI_ALGORITHMS, "Unsupported SRI algorithm"
+
     try:
         with urllib.request.urlopen(url) as response:
-            return response.read()
+            return sri(_update_from_stream(SRI_ALGORITHMS[algorithm](), response))
     except urllib.error.URLError as e:
         raise RuntimeError(f"Failed to download {url}: {e}")
 
 
-def read_file(path):
-    """Read file from local path."""
-    with open(path, "rb") as f:
-        return f.read()
+def hashing_executor():
+    """Create thread pool for hashing local files and downloaded archives."""
+    # hashlib releases the GIL on large buffers, small files still overlap I/O
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
 
 
-def integrity(data, algorithm="sha256"):
-    """Calculate integrity hash in SRI format."""
-    assert algorithm in {
-        "sha224",
-        "sha256", 
-        "sha384",
-        "sha512",
-    }, "Unsupported SRI algorithm"
+def integrity_files(executor, items, algorithm="sha256", known=None, known_mtime_ns=None, cache=None):
+    """Submit integrity hashing of (key, entry) pairs of local files to executor.
     
-    hash_obj = getattr(hashlib, algorithm)(data)
-    encoded = base64.b64encode(hash_obj.digest()).decode()
-    return f"{algorithm}-{encoded}"
+    Files modified before known_mtime_ns reuse their integrity from known by key.
+    Hashes of the same inode are shared through cache dict, see integrity_entry().
+    Returns iterator of (key, integrity) pairs in input order.
+    """
+    def item_integrity(item):
+        key, entry = item
+        if known_mtime_ns is not None and key in known:
+            # Strictly older: coarse timestamps may tie with an edit right after the write
+            if entry.stat().st_mtime_ns < known_mtime_ns:
+                return key, known[key]
+        return key, integrity_entry(entry, algorithm, cache)
+    
+    return executor.map(item_integrity, items)
+
+
+def walk_files(root):
+    """Recursively yield (relative_path, entry) for files under root."""
+    root = os.fspath(root)
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield os.path.relpath(entry.path, root), entry
+
+
+def is_dir(path):
+    """Check that path is a directory with a single stat."""
+    try:
+        return stat.S_ISDIR(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def list_files(path):
+    """Get directory entries of files, empty if path does not exist."""
+    try:
+        with os.scandir(path) as entries:
+            # d_type from the directory listing answers is_file() without a stat per entry
+            return [entry for entry in entries if entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def list_dirs(path):
+    """Get names of subdirectories, empty if path does not exist."""
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def json_load(file_path):
+    """Read JSON data from file."""
+    with open(file_path, encoding="utf-8") as f:
+        return _json_decoder.decode(f.read())
 
 
 def json_dump(file_path, data, sort_keys=False):
     """Write JSON data to file with consistent formatting."""
-    with open(file_path, "w", newline="\n") as f:
-        json.dump(data, f, indent=4, sort_keys=sort_keys)
-        f.write("\n")
+    payload = memoryview((json.dumps(data, indent=4, sort_keys=sort_keys) + "\n").encode())
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(file_path, flags, 0o666)
+    try:
+        while payload:
+            payload = payload[os.write(fd, payload):]
+    finally:
+        os.close(fd)
 
 
 class PrivateRegistryClient:
@@ -73,132 +236,187 @@ class PrivateRegistryClient:
                 f"Not a valid registry: missing bazel_registry.json in {self.root}"
             )
     
-    def get_modules_dir(self):
-        """Get modules directory path."""
-        config = self.get_registry_config()
-        module_base_path = config.get("module_base_path", "modules")
+    @functools.cached_property
+    def modules_dir(self):
+        """Modules directory path."""
+        module_base_path = self.registry_config.get("module_base_path", "modules")
         return self.root / module_base_path
     
-    def get_registry_config(self):
-        """Get bazel_registry.json content."""
-        config_path = self.root / "bazel_registry.json"
-        with open(config_path) as f:
-            return json.load(f)
+    @functools.cached_property
+    def registry_config(self):
+        """bazel_registry.json content."""
+        return json_load(self.root / "bazel_registry.json")
     
     def get_all_modules(self):
         """Get list of all available modules."""
-        modules_dir = self.get_modules_dir()
-        if not modules_dir.exists():
-            return []
-        return [d.name for d in modules_dir.iterdir() if d.is_dir()]
+        return list_dirs(self.modules_dir)
     
     def get_module_versions(self, module_name):
         """Get list of versions for a module."""
-        module_dir = self.get_modules_dir() / module_name
-        if not module_dir.exists():
-            return []
-        return [d.name for d in module_dir.iterdir() if d.is_dir()]
+        return list_dirs(self.modules_dir / module_name)
     
     def get_source_json_path(self, module_name, version):
         """Get path to source.json file."""
-        return self.get_modules_dir() / module_name / version / "source.json"
+        return self.modules_dir / module_name / version / "source.json"
     
     def get_source(self, module_name, version):
         """Load source.json content."""
-        source_path = self.get_source_json_path(module_name, version)
+        return self._load_source(self.get_source_json_path(module_name, version))
+    
+    def _load_source(self, source_path):
+        """Load source.json content from path."""
         if not source_path.exists():
             raise RuntimeError(f"source.json not found: {source_path}")
         
-        with open(source_path) as f:
-            return json.load(f)
+        return json_load(source_path)
     
     def get_overlay_dir(self, module_name, version):
         """Get overlay directory path."""
-        return self.get_modules_dir() / module_name / version / "overlay"
+        return self.modules_dir / module_name / version / "overlay"
     
     def get_patches_dir(self, module_name, version):
         """Get patches directory path."""
-        return self.get_modules_dir() / module_name / version / "patches"
+        return self.modules_dir / module_name / version / "patches"
     
     def module_exists(self, module_name, version=None):
         """Check if module (and optionally version) exists."""
-        modules_dir = self.get_modules_dir()
-        module_dir = modules_dir / module_name
+        module_dir = self.modules_dir / module_name
+        if version is not None:
+            module_dir = module_dir / version
         
-        if not module_dir.exists():
-            return False
+        return is_dir(module_dir)
+    
+    def _paths(self, module_name, version):
+        """Get (version_dir, source_path, overlay_dir, patches_dir) of module version."""
+        version_dir = self.modules_dir / module_name / version
+        return (
+            version_dir,
+            version_dir / "source.json",
+            version_dir / "overlay",
+            version_dir / "patches",
+        )
+    
+    def update_integrity(self, module_name, version, incremental=False):
+        """Update SRI hashes in source.json file.
         
-        if version is None:
-            return True
+        With incremental, overlay and patch files not modified since source.json
+        was written keep their recorded hashes instead of being rehashed.
+        """
+        cache = {}
+        with hashing_executor() as executor:
+            update = self._submit_update(executor, cache, module_name, version, incremental)
+            self._finish_update(*update)
+    
+    def update_all(self, incremental=False):
+        """Update SRI hashes in source.json files of all modules and versions.
         
-        version_dir = module_dir / version
-        return version_dir.exists()
+        Hashing for every version is submitted to one shared thread pool
+        before any source.json is written. A failing version is reported and
+        skipped, RuntimeError listing all failed versions is raised at the end.
+        """
+        cache = {}
+        updates = []
+        failed = []
+        with hashing_executor() as executor:
+            for module_name in sorted(self.get_all_modules()):
+                for version in sorted(self.get_module_versions(module_name)):
+                    try:
+                        updates.append(self._submit_update(executor, cache, module_name, version, incremental))
+                    except Exception as e:
+                        print(f"ERROR: {module_name}@{version}: {e}")
+                        failed.append(f"{module_name}@{version}")
+            
+            for update in updates:
+                try:
+                    self._finish_update(*update)
+                except Exception as e:
+                    label = update[0]
+                    print(f"ERROR: {label}: {e}")
+                    failed.append(label)
+        
+        if failed:
+            raise RuntimeError(f"Failed to update {len(failed)} module versions: {', '.join(failed)}")
     
-    def update_integrity(self, module_name, version):
-        """Update SRI hashes in source.json file."""
-        if not self.module_exists(module_name, version):
+    def _submit_update(self, executor, cache, module_name, version, incremental):
+        """Load source.json and submit hashing of its archive, patches and overlay."""
+        label = f"{module_name}@{version}"
+        version_dir, source_path, overlay_dir, patches_dir = self._paths(module_name, version)
+        if not is_dir(version_dir):
             raise RuntimeError(f"Module {module_name}@{version} not found")
         
-        source = self.get_source(module_name, version)
-        source_path = self.get_source_json_path(module_name, version)
+        source = self._load_source(source_path)
+        source_mtime_ns = source_path.stat().st_mtime_ns if incremental else None
         
-        # Update main archive integrity
+        # Main archive integrity
+        archive = None
         if "url" in source:
-            print(f"Downloading and calculating integrity for {source['url']}")
-            archive_data = download(source["url"])
-            source["integrity"] = integrity(archive_data)
-            print(f"Updated main archive integrity: {source['integrity']}")
+            print(f"{label}: Downloading and calculating integrity for {source['url']}")
+            archive = executor.submit(url_integrity, source["url"])
+        
+        # Patches integrity
+        patches = None
+        available_patches = list_files(patches_dir)
+        if available_patches:
+            patches = integrity_files(
+                executor,
+                ((entry.name, entry) for entry in available_patches),
+                known=source.get("patches", {}),
+                known_mtime_ns=source_mtime_ns,
+                cache=cache,
+            )
+        
+        # Overlay integrity, hashing starts while the walk is still discovering files
+        overlay = None
+        if overlay_dir.exists():
+            overlay = integrity_files(
+                executor,
+                (
+                    (relative_path, entry)
+                    for relative_path, entry in walk_files(overlay_dir)
+                    if entry.name != "MODULE.bazel.lock"
+                ),
+                known=source.get("overlay", {}),
+                known_mtime_ns=source_mtime_ns,
+                cache=cache,
+            )
+        
+        return label, source_path, source, archive, patches, overlay
+    
+    def _finish_update(self, label, source_path, source, archive, patches, overlay):
+        """Collect submitted hashes and write updated source.json."""
+        # Update main archive integrity
+        if archive is not None:
+            source["integrity"] = archive.result()
+            print(f"{label}: Updated main archive integrity: {source['integrity']}")
         
         # Update patches integrity
-        patches_dir = self.get_patches_dir(module_name, version)
-        if patches_dir.exists():
+        if patches is not None:
             current_patches = source.get("patches", {})
-            available_patches = [p for p in patches_dir.iterdir() if p.is_file()]
+            patches = dict(patches)
+            for patch_name, patch_integrity in patches.items():
+                if patch_name in current_patches:
+                    if current_patches[patch_name] != patch_integrity:
+                        print(f"{label}: Updated patch {patch_name}: {patch_integrity}")
+                else:
+                    print(f"{label}: Added new patch {patch_name}: {patch_integrity}")
             
-            if available_patches:
-                patches = {}
-                for patch_file in available_patches:
-                    patch_name = patch_file.name
-                    patch_data = read_file(patch_file)
-                    patch_integrity = integrity(patch_data)
-                    patches[patch_name] = patch_integrity
-                    
-                    if patch_name in current_patches:
-                        if current_patches[patch_name] != patch_integrity:
-                            print(f"Updated patch {patch_name}: {patch_integrity}")
-                    else:
-                        print(f"Added new patch {patch_name}: {patch_integrity}")
-                
-                source["patches"] = patches
-            else:
-                # No patches exist, remove patches section
-                source.pop("patches", None)
+            source["patches"] = patches
         else:
-            # No patches directory, remove patches section
+            # No patches directory or patches, remove patches section
             source.pop("patches", None)
         
         # Update overlay integrity
-        overlay_dir = self.get_overlay_dir(module_name, version)
-        if overlay_dir.exists():
-            overlay_files = []
-            for path in overlay_dir.rglob("*"):
-                if path.is_file() and path.name != "MODULE.bazel.lock":
-                    overlay_files.append(path)
+        if overlay is not None:
+            current_overlay = source.get("overlay", {})
+            overlay = dict(sorted(overlay))
             
-            if overlay_files:
-                overlay = {}
-                for overlay_file in overlay_files:
-                    relative_path = str(overlay_file.relative_to(overlay_dir))
-                    overlay_data = read_file(overlay_file)
-                    overlay_integrity = integrity(overlay_data)
-                    overlay[relative_path] = overlay_integrity
-                    
-                    current_overlay = source.get("overlay", {})
+            if overlay:
+                for relative_path, overlay_integrity in overlay.items():
                     if relative_path in current_overlay:
                         if current_overlay[relative_path] != overlay_integrity:
-                            print(f"Updated overlay {relative_path}: {overlay_integrity}")
+                            print(f"{label}: Updated overlay {relative_path}: {overlay_integrity}")
                     else:
-                        print(f"Added new overlay {relative_path}: {overlay_integrity}")
+                        print(f"{label}: Added new overlay {relative_path}: {overlay_integrity}")
                 
                 source["overlay"] = overlay
             else:
@@ -210,7 +428,7 @@ class PrivateRegistryClient:
         
         # Write updated source.json
         json_dump(source_path, source, sort_keys=False)
-        print(f"Updated {source_path}")
+        print(f"{label}: Updated {source_path}")
 
 
 def main():
@@ -220,15 +438,32 @@ def main():
     parser = argparse.ArgumentParser(
         description="Update the SRI hashes in source.json files for private registry modules"
     )
-    parser.add_argument("module", help="Module name to update")
+    parser.add_argument("module", nargs="?", help="Module name to update")
+    parser.add_argument("--all", action="store_true", help="Update all versions of all modules")
     parser.add_argument("--version", help="Module version (uses latest if not specified)")
     parser.add_argument("--registry", default=".", help="Path to registry root (default: current directory)")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse hashes of overlay/patch files not modified since source.json was written",
+    )
     
     args = parser.parse_args()
+    if args.all:
+        if args.module or args.version:
+            parser.error("--all cannot be combined with module or --version")
+    elif not args.module:
+        parser.error("module is required unless --all is given")
     
     try:
         client = PrivateRegistryClient(args.registry)
         
+        if args.all:
+            print(f"Updating integrity for all modules in {args.registry}")
+            client.update_all(incremental=args.incremental)
+            print("Done!")
+            return
+        
         if not client.module_exists(args.module):
             available = client.get_all_modules()
             print(f"ERROR: Module '{args.module}' not found in registry.")
@@ -255,7 +490,7 @@ def main():
             sys.exit(1)
         
         print(f"Updating integrity for {args.module}@{version} in {args.registry}")
-        client.update_integrity(args.module, version)
+        client.update_integrity(args.module, version, incremental=args.incremental)
         print("Done!")
         
     except Exception as e: